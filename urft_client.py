@@ -1,91 +1,200 @@
 import socket
 import os
+import mmap
+import array
+import bisect
 import struct
 import sys
 import time
 import random
 import hashlib
+import heapq
+import queue
+import threading
+
+from urft_net import configure_socket, recv_batch, recv_datagram, send_batch, SEND_BATCH
 
 # Constants
 BUFFER_SIZE = 4096  # Increased from 1024 to handle larger datagrams
-CHUNK_SIZE = 1024   # Size of data chunks (keep this at 1024)
-TIMEOUT = 0.2       # Retransmission timeout in seconds
+RECV_BATCH = 32     # Max ACKs drained from the socket per wakeup
+CHUNK_SIZE = 1024   # Fallback chunk size when no path MTU probe gets through
+HEADER_SIZE = struct.calcsize("!II")  # Sequence number + total packets
+ACK_HEADER_SIZE = struct.calcsize("!II")  # Cumulative ACK + SACK bitmap base
+SACK_BITMAP_SIZE = 32  # Optional selective ACK bitmap appended to the ACK header
+MTU_PROBE_SIZES = (8972, 1472, 1200)  # Datagram sizes for jumbo frames, Ethernet and the QUIC-safe minimum
+MTU_PROBE_TIMEOUT = 1.0  # How long to wait for probe echoes
+TIMEOUT = 0.2       # Retransmission timeout in seconds (until the first RTT sample)
+HEADER_TIMEOUT = 1.0  # Wait for the header ACK long enough to measure high RTTs on it
+ACK_READER_POLL = 0.05  # How often the ACK reader thread checks whether it should stop
+MIN_RTO = 0.05      # Lower bound for the adaptive retransmission timeout
+MAX_RTO = 3.0       # Upper bound for the adaptive retransmission timeout (incl. backoff)
+RTT_ALPHA = 0.125   # SRTT gain (Van Jacobson / RFC 6298)
+RTT_BETA = 0.25     # RTTVAR gain
 WINDOW_SIZE = 32    # Number of packets that can be in flight
 MAX_RETRIES = 25    # Increased maximum retries for challenging networks
 MAX_TRANSFER_TIME = 120  # Increased time limit for Case 6 (high RTT)
+HASH_ALGO = "blake2b"    # Integrity hash sent in the header (C-optimized in hashlib)
+HASH_BLOCK_SIZE = 1 << 20  # Read 1 MiB at a time while hashing
+
+# Burst size policy: the phase rises with the progress deficit or as the time budget runs out
+DEFICIT_THRESHOLDS = (5, 10, 15)  # Progress deficit (percent) above which the next phase starts
+TIME_THRESHOLDS = (30, 50, 70)    # Remaining time (percent) below which the next phase starts
+FINAL_PUSH_PHASE = 4              # Under 20% of the time left with over 75% done
+BASE_BURST = (8, 16, 32, 64, 128)  # Packets per burst for each phase
+# (high_rtt_mode, extreme_rtt_mode, phase, under half the time left) -> max burst;
+# high RTT bursts 1.5x, extreme RTT (Case 6) 2x, or 4x once half the time is gone
+BURST_TABLE = {
+    (high, extreme, phase, late): (burst * 3 // 2 if high else burst) * ((4 if late else 2) if extreme else 1)
+    for high in (False, True)
+    for extreme in (False, True)
+    for phase, burst in enumerate(BASE_BURST)
+    for late in (False, True)
+}
+
+# Precompiled packet layouts (skip the format-string lookup on every call)
+_HDR = struct.Struct("!II")  # Data packet header: seq_num, total_packets
+_HDR_PACK_INTO = _HDR.pack_into
+_ACK_UNPACK_FROM = struct.Struct("!II").unpack_from  # ACK header: cumulative ack, SACK base
+TERM_ACK_MARKER = 0xFFFFFFFF  # SACK base of the termination ACK, never used by data ACKs
+
+def ack_reader(sock, sel, ack_queue, stop_event):
+    # Receive ACKs in the background and hand them to the sender through ack_queue,
+    # so that reading them never holds up the next send burst
+    while not stop_event.is_set():
+        if sel.select(ACK_READER_POLL):
+            for ack, _ in recv_batch(sock, RECV_BATCH, BUFFER_SIZE):
+                ack_queue.put(ack)
+
+def next_deadline(timers, deadline, in_flight):
+    # Earliest pending retransmission deadline in the (deadline, seq_num) heap, or None.
+    # Entries for ACKed or rescheduled packets are stale and dropped lazily here.
+    while timers:
+        when, seq_num = timers[0]
+        if seq_num in in_flight and deadline[seq_num] == when:
+            return when
+        heapq.heappop(timers)
+    return None
+
+def find_timeouts(timers, deadline, in_flight, now_ns):
+    # Pop the in-flight sequence numbers whose retransmission deadline has passed, earliest first.
+    # Only expired entries are touched, the rest of the window is never scanned.
+    timed_out = []
+    while timers and timers[0][0] <= now_ns:
+        when, seq_num = heapq.heappop(timers)
+        if seq_num in in_flight and deadline[seq_num] == when:
+            timed_out.append(seq_num)
+    return timed_out
+
+def probe_chunk_size(sock, sel, server_addr):
+    # Send one don't-fragment probe per candidate datagram size (twice, in case of loss)
+    # and use the largest size the server echoes back
+    sent_sizes = set()
+    for size in MTU_PROBE_SIZES * 2:
+        try:
+            sock.sendto(b"MTU_PROBE".ljust(size, b"\0"), server_addr)
+            sent_sizes.add(size)
+        except OSError:
+            pass  # Larger than the local interface MTU (EMSGSIZE with the don't-fragment bit set)
+
+    # No need to wait for echoes once the largest probe that left this host came back
+    largest_sent = max(sent_sizes, default=0)
+    best_size = 0
+    deadline = time.monotonic() + MTU_PROBE_TIMEOUT
+    while best_size < largest_sent:
+        received = recv_datagram(sock, sel, BUFFER_SIZE, deadline - time.monotonic())
+        if received is None:
+            break
+        response = received[0]
+        if response.startswith(b"MTU_ACK") and len(response) == 11:
+            best_size = max(best_size, struct.unpack_from("!I", response, 7)[0])
+
+    if best_size in MTU_PROBE_SIZES:
+        return best_size - HEADER_SIZE
+    return CHUNK_SIZE
 
 def send_file(file_path, server_ip, server_port):
     print(f"Starting transfer with connection to {server_ip}:{server_port}")
     print("NOTE: Configure and run Clumsy if testing network conditions")
     
     start_time = time.time()
+    start_ns = time.monotonic_ns()  # The MAX_TRANSFER_TIME budget covers the whole transfer, setup included
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(TIMEOUT)
 
-    # Set socket buffer size to handle larger packets
-    try:
-        # Increase socket buffer sizes
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)  # 256 KB receive buffer
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)  # 256 KB send buffer
-    except:
-        print("Warning: Couldn't set socket buffer size")
+    # Set socket buffer sizes (tunable via URFT_RCVBUF/URFT_SNDBUF) and path MTU discovery,
+    # waits go through the selector instead of socket timeouts
+    sel = configure_socket(sock)
     
     file_size = os.path.getsize(file_path)
     file_name = os.path.basename(file_path)
     
-    # Calculate MD5 hash of the file for verification
-    md5_hash = hashlib.md5()
+    # Calculate hash of the file for verification
+    file_hash = hashlib.new(HASH_ALGO)
     with open(file_path, "rb") as f_hash:
-        for chunk in iter(lambda: f_hash.read(4096), b""):
-            md5_hash.update(chunk)
-    file_md5 = md5_hash.hexdigest()
-    print(f"File MD5: {file_md5}")
+        for chunk in iter(lambda: f_hash.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(chunk)
+    file_digest = file_hash.hexdigest()
+    print(f"File {HASH_ALGO}: {file_digest}")
     
+    # Pick the largest payload the path carries without fragmentation
+    chunk_size = probe_chunk_size(sock, sel, (server_ip, server_port))
+    packet_size = HEADER_SIZE + chunk_size
+    print(f"Using {chunk_size}-byte chunks ({packet_size}-byte datagrams)")
+
+    # Build the packets before the header goes out: the server reads the gap between
+    # its HEADER_ACK and the first data packet as the RTT
+    with open(file_path, "rb") as f:
+        # Map the file instead of reading it into a list of chunks
+        total_packets = (file_size + chunk_size - 1) // chunk_size
+        print(f"File split into {total_packets} packets")
+
+        # Prebuild every packet into one contiguous buffer (only the last packet may be short)
+        packets = bytearray(total_packets * HEADER_SIZE + file_size)
+        if file_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as file_view:
+                for i in range(total_packets):
+                    chunk = file_view[i * chunk_size:(i + 1) * chunk_size]
+                    offset = i * packet_size
+                    _HDR_PACK_INTO(packets, offset, i, total_packets)
+                    packets[offset + HEADER_SIZE:offset + HEADER_SIZE + len(chunk)] = chunk
+                    chunk.release()
+    packet_view = memoryview(packets)
+
     print(f"Sending file: {file_name} ({file_size} bytes)")
     
-    # Send file name, size and MD5 hash first
-    header = f"{file_name}:{file_size}:{file_md5}".encode()
+    # Send file name, size, hash algorithm, digest and chunk size first
+    header = f"{file_name}:{file_size}:{HASH_ALGO}:{file_digest}:{chunk_size}".encode()
     ack_received = False
     retries = 0
     
+    initial_rtt = None
+    
     while not ack_received and retries < MAX_RETRIES:
-        try:
-            sock.sendto(header, (server_ip, server_port))
-            # Wait for header acknowledgement
-            ack, _ = sock.recvfrom(BUFFER_SIZE)
-            if ack.decode() == "HEADER_ACK":
-                ack_received = True
-            else:
-                retries += 1
-        except socket.timeout:
+        header_send_time = time.monotonic()
+        sock.sendto(header, (server_ip, server_port))
+        # Wait for header acknowledgement
+        received = recv_datagram(sock, sel, BUFFER_SIZE, HEADER_TIMEOUT)
+        while received is not None and received[0].startswith(b"MTU_ACK"):  # Late echo of a duplicate MTU probe
+            received = recv_datagram(sock, sel, BUFFER_SIZE, HEADER_TIMEOUT)
+        if received is None:
             retries += 1
             print(f"Header timeout! Retry {retries}/{MAX_RETRIES}")
+        elif received[0] == b"HEADER_ACK":
+            ack_received = True
+            # The header exchange doubles as the first RTT sample, unless the header was
+            # retransmitted and the ACK may belong to an earlier copy (Karn's rule)
+            if retries == 0:
+                initial_rtt = time.monotonic() - header_send_time
+        else:
+            retries += 1
     
     if retries >= MAX_RETRIES:
         print("Failed to send file header after maximum retries")
         sock.close()
         return False
     
-    # Detect high RTT based on header exchange timing
-    initial_rtt = 0
-    for attempt in range(3):
-        start_probe = time.time()
-        sock.sendto(b"RTT_PROBE", (server_ip, server_port))
-        try:
-            sock.settimeout(1.0)  # Longer timeout for RTT detection
-            probe_response, _ = sock.recvfrom(BUFFER_SIZE)
-            if probe_response == b"RTT_ACK":
-                initial_rtt = time.time() - start_probe
-                break
-        except socket.timeout:
-            pass
-
-    # Reset socket timeout to normal
-    sock.settimeout(TIMEOUT)
-
-    # Adapt parameters based on detected RTT
-    high_rtt_mode = initial_rtt > 0.1  # Over 100ms RTT
-    extreme_rtt_mode = initial_rtt > 0.2  # Over 200ms RTT (Case 6)
+    # Adapt parameters based on detected RTT (defaults if there is no valid sample)
+    high_rtt_mode = initial_rtt is not None and initial_rtt > 0.1  # Over 100ms RTT
+    extreme_rtt_mode = initial_rtt is not None and initial_rtt > 0.2  # Over 200ms RTT (Case 6)
     
     if extreme_rtt_mode:
         print(f"Detected extreme RTT: {initial_rtt*1000:.0f}ms - Using aggressive parameters")
@@ -95,169 +204,217 @@ def send_file(file_path, server_ip, server_port):
         print(f"Detected high RTT: {initial_rtt*1000:.0f}ms - Adapting parameters")
         effective_timeout = max(0.5, initial_rtt * 2)  # Dynamic timeout based on RTT
         effective_window = min(128, WINDOW_SIZE * 4)  # Larger window for high RTT
+    elif initial_rtt is None:
+        # The header had to be retransmitted, so there is no RTT sample, and the RTT may exceed
+        # the header wait; start from a backed-off RTO until the first data ACK gives a sample
+        effective_timeout = HEADER_TIMEOUT * 2 ** retries
+        effective_window = WINDOW_SIZE
     else:
         effective_timeout = TIMEOUT
         effective_window = WINDOW_SIZE
     
+    server_addr = (server_ip, server_port)
+
+    # Smoothed RTT estimator (nanoseconds), seeded from the header exchange when it gave a
+    # valid sample (RFC 6298); the RTO starts from the RTT-mode timeout and follows the
+    # estimator once data is ACKed
+    min_rto_ns = int(MIN_RTO * 1e9)
+    max_rto_ns = int(MAX_RTO * 1e9)
+    srtt = None
+    rttvar = 0.0
+    if initial_rtt is not None:
+        srtt = initial_rtt * 1e9
+        rttvar = srtt / 2
+    rto_ns = min(int(effective_timeout * 1e9), max_rto_ns)
+
     # Prepare sliding window
-    window = {}  # seq_num -> (packet_data, sent_time, retries)
     next_seq_num = 0
     base_seq_num = 0  # First unacknowledged packet
     
-    with open(file_path, "rb") as f:
-        # Read all file data into chunks for easier window management
-        chunks = []
-        while True:
-            chunk = f.read(CHUNK_SIZE)
-            if not chunk:
-                break
-            chunks.append(chunk)
-        
-        total_packets = len(chunks)
-        print(f"File split into {total_packets} packets")
-        
+    # Per-packet window state as parallel arrays indexed by sequence number
+    sent_time = array.array('q', [0]) * total_packets  # Last send time (monotonic ns)
+    retry_counts = array.array('B', [0]) * total_packets
+    deadline = array.array('q', [0]) * total_packets  # Retransmission deadline (monotonic ns)
+    acked = bytearray(total_packets)
+    in_flight = set()  # Sent but not yet acknowledged
+    timers = []  # Heap of (deadline, seq_num), one entry per (re)send
+    progress_step = max(1, total_packets // (40 if high_rtt_mode else 20))  # More frequent updates for high RTT
+    next_progress_report = progress_step
+    ack_credit = 1  # Packets newly covered by the last ACK, each one earns a full burst
+    
+    # ACKs are read by a background thread while this one sends
+    ack_queue = queue.SimpleQueue()
+    stop_reader = threading.Event()
+    reader = threading.Thread(target=ack_reader, args=(sock, sel, ack_queue, stop_reader), daemon=True)
+    reader.start()
+    try:
         # Process until all packets are acknowledged
         while base_seq_num < total_packets:
-            current_time = time.time()
-            if current_time - start_time > MAX_TRANSFER_TIME:
+            # One monotonic clock read per iteration, shared by every packet sent in this burst
+            now_ns = time.monotonic_ns()
+            elapsed = (now_ns - start_ns) / 1e9
+            if elapsed > MAX_TRANSFER_TIME:
                 print(f"Transfer exceeded time limit of {MAX_TRANSFER_TIME} seconds. Aborting.")
-                sock.close()
                 return False
 
             # Adaptive sending strategy based on remaining time
-            remaining_time_percent = (MAX_TRANSFER_TIME - (current_time - start_time)) / MAX_TRANSFER_TIME * 100
+            remaining_time_percent = (MAX_TRANSFER_TIME - elapsed) / MAX_TRANSFER_TIME * 100
             expected_progress_percent = 100 - remaining_time_percent  # What percentage should be done by now
             actual_progress_percent = (base_seq_num / total_packets) * 100  # What percentage is actually done
-            
+        
             progress_deficit = expected_progress_percent - actual_progress_percent
 
-            # Send packets more aggressively when time is running low
+            # Send packets more aggressively when behind schedule or time is running low
             send_count = 0
-            max_burst = 12 if high_rtt_mode else 8  # Higher burst for high RTT
-
-            # Adjust burst size based on deficit and remaining time
-            if progress_deficit > 5 or remaining_time_percent < 70:
-                max_burst = 24 if high_rtt_mode else 16
-                
-            if progress_deficit > 10 or remaining_time_percent < 50:
-                max_burst = 48 if high_rtt_mode else 32
-                
-            if progress_deficit > 15 or remaining_time_percent < 30:
-                max_burst = 96 if high_rtt_mode else 64
-
-            # For the final push when we're close to the end
             if remaining_time_percent < 20 and actual_progress_percent > 75:
-                max_burst = 192 if high_rtt_mode else 128
-                
-            # For Case 6 (extreme RTT), use even more aggressive bursting
-            if extreme_rtt_mode:
-                max_burst *= 2
-                if remaining_time_percent < 50:
-                    max_burst *= 2  # Even more aggressive for Case 6 when time is running out
+                phase = FINAL_PUSH_PHASE
+            else:
+                phase = max(bisect.bisect_left(DEFICIT_THRESHOLDS, progress_deficit),
+                            len(TIME_THRESHOLDS) - bisect.bisect_right(TIME_THRESHOLDS, remaining_time_percent))
+            max_burst = BURST_TABLE[(high_rtt_mode, extreme_rtt_mode, phase, remaining_time_percent < 50)]
+
+            # A cumulative ACK stands in for one per-packet ACK per packet it covers
+            max_burst *= ack_credit
+            ack_credit = 1
 
             # Send packets more aggressively with adaptive window size
             current_window_size = effective_window
-            while len(window) < current_window_size and next_seq_num < total_packets and send_count < max_burst:
-                chunk = chunks[next_seq_num]
-                packet = struct.pack("!II", next_seq_num, total_packets) + chunk
-                window[next_seq_num] = (packet, time.time(), 0)
-                sock.sendto(packet, (server_ip, server_port))
+            pending = []  # Packets queued for the next batched send
+            fresh_deadline = now_ns + rto_ns
+            while len(in_flight) < current_window_size and next_seq_num < total_packets and send_count < max_burst:
+                sent_time[next_seq_num] = now_ns
+                deadline[next_seq_num] = fresh_deadline
+                heapq.heappush(timers, (fresh_deadline, next_seq_num))
+                in_flight.add(next_seq_num)
+                pending.append(packet_view[next_seq_num * packet_size:(next_seq_num + 1) * packet_size])
+                if len(pending) >= SEND_BATCH:
+                    send_batch(sock, pending, server_addr)
+                    pending = []
                 next_seq_num += 1
                 send_count += 1
-            
-            # Check for ACKs and timeouts
+            if pending:
+                send_batch(sock, pending, server_addr)
+        
+            # Wait for the reader thread to deliver ACKs, at most until the earliest
+            # retransmission deadline, then drain every queued ACK in one go
+            wait = TIMEOUT
+            earliest = next_deadline(timers, deadline, in_flight)
+            if earliest is not None:
+                wait = min(wait, max(0, (earliest - time.monotonic_ns()) / 1e9))
             try:
-                ack, _ = sock.recvfrom(BUFFER_SIZE)
-                try:
-                    ack_num = struct.unpack("!I", ack)[0]
-                    
-                    if ack_num in window:
-                        # Got ACK for a packet in our window
-                        del window[ack_num]
-                        
-                        # Update base if possible
-                        while base_seq_num < total_packets and base_seq_num not in window:
-                            base_seq_num += 1
-
-                        # Dynamically adjust window size based on progress
-                        if remaining_time_percent < 40 and len(window) < current_window_size//2:
-                            # If we're making good progress despite time pressure, be more aggressive
-                            # Try to send multiple packets for each ACK received when window is not full
-                            for _ in range(min(3, current_window_size - len(window))):
-                                if next_seq_num < total_packets:
-                                    chunk = chunks[next_seq_num]
-                                    packet = struct.pack("!II", next_seq_num, total_packets) + chunk
-                                    window[next_seq_num] = (packet, time.time(), 0)
-                                    sock.sendto(packet, (server_ip, server_port))
-                                    next_seq_num += 1
-                            
-                        # More frequent progress updates for high RTT
-                        if (base_seq_num % (total_packets // (40 if high_rtt_mode else 20))) == 0:
-                            progress = (base_seq_num / total_packets) * 100
-                            print(f"Progress: {progress:.1f}% (ACK: {ack_num})")
-                except struct.error:
-                    print("Received malformed ACK, ignoring")
-                    
-            except socket.timeout:
-                # Check for packets that need retransmission
-                current_time = time.time()
-                for seq_num in list(window.keys()):
-                    packet, sent_time, retries = window[seq_num]
-                    
-                    # Calculate dynamic timeout based on RTT mode
-                    if extreme_rtt_mode:
-                        # For Case 6, use specialized timeouts
-                        if retries == 0:
-                            dynamic_timeout = effective_timeout  # First attempt uses base timeout
-                        elif retries <= 3:
-                            dynamic_timeout = effective_timeout * (1.1 ** retries)  # Very gentle backoff for Case 6
-                        else:
-                            dynamic_timeout = effective_timeout * (1.2 ** min(retries-3, 3))  # Limited backoff later
-                    elif high_rtt_mode:
-                        # For high RTT, use more conservative timeouts
-                        if retries == 0:
-                            dynamic_timeout = effective_timeout  # First attempt uses base timeout
-                        elif retries <= 3:
-                            dynamic_timeout = effective_timeout * (1.2 ** retries)  # Gentle backoff for initial retries
-                        else:
-                            dynamic_timeout = effective_timeout * (1.5 ** min(retries-3, 3))  # More aggressive backoff later
-                    else:
-                        # Original logic for low RTT
-                        if retries <= 1:
-                            dynamic_timeout = TIMEOUT * 0.8
-                        elif retries <= 3: 
-                            dynamic_timeout = TIMEOUT
-                        else:
-                            dynamic_timeout = TIMEOUT * (1.05 ** (retries - 3))
-
-                    # Adjust timeout based on remaining time and progress
-                    remaining_time_percent = (MAX_TRANSFER_TIME - (current_time - start_time)) / MAX_TRANSFER_TIME * 100
-                    if remaining_time_percent < 50:
-                        # When time is running out, reduce timeout aggressively
-                        dynamic_timeout = max(TIMEOUT * 0.2, dynamic_timeout * 0.4)
-                    elif remaining_time_percent < 25:
-                        # Almost out of time - use absolute minimum timeout
-                        dynamic_timeout = TIMEOUT * 0.15
-
-                    # Special handling for final phase - super aggressive
-                    if remaining_time_percent < 20 and actual_progress_percent > 75:
-                        dynamic_timeout = TIMEOUT * 0.1  # Ultra-minimal timeout for final push
-                    
-                    if current_time - sent_time > dynamic_timeout:
-                        if retries >= MAX_RETRIES:
-                            print(f"Packet {seq_num} failed after {MAX_RETRIES} retries")
-                            sock.close()
-                            return False
-                        
-                        # Retransmit with exponential backoff
-                        sock.sendto(packet, (server_ip, server_port))
-                        window[seq_num] = (packet, current_time, retries + 1)
-                        # Only print occasionally to avoid slowing down execution
-                        if retries <= 1 or retries % 5 == 0:
-                            print(f"Timeout! Resending packet {seq_num} (retry {retries+1})")
-    
+                acks = [ack_queue.get(timeout=wait)]
+                while not ack_queue.empty():
+                    acks.append(ack_queue.get_nowait())
+            except queue.Empty:
+                acks = []
+
+            if acks:
+                now_ns = time.monotonic_ns()
+                ack_credit = 0
+                for ack in acks:
+                    # ACK = cumulative ack (everything below it arrived) + base of the optional SACK bitmap
+                    if len(ack) != ACK_HEADER_SIZE and len(ack) != ACK_HEADER_SIZE + SACK_BITMAP_SIZE:
+                        print("Received malformed ACK, ignoring")  # e.g. a late probe echo
+                        continue
+                    try:
+                        cum_ack, sack_base = _ACK_UNPACK_FROM(ack)
+                        sack_bitmap = int.from_bytes(ack[ACK_HEADER_SIZE:], "little")
+
+                        newly_acked = list(range(base_seq_num, min(cum_ack, next_seq_num)))
+                        while sack_bitmap:
+                            low_bit = sack_bitmap & -sack_bitmap
+                            newly_acked.append(sack_base + low_bit.bit_length() - 1)
+                            sack_bitmap ^= low_bit
+
+                        rtt_sent_time = None
+                        for ack_num in newly_acked:
+                            if ack_num not in in_flight:
+                                continue
+                            ack_credit += 1
+                            acked[ack_num] = 1
+                            in_flight.discard(ack_num)
+                            # Only sample RTT from packets that were never retransmitted (Karn's rule)
+                            if retry_counts[ack_num] == 0 and (rtt_sent_time is None or sent_time[ack_num] > rtt_sent_time):
+                                rtt_sent_time = sent_time[ack_num]
+
+                        if rtt_sent_time is not None:
+                            # One sample per ACK, from the most recently sent packet it covers
+                            sample = now_ns - rtt_sent_time
+                            if srtt is None:
+                                srtt = sample
+                                rttvar = sample / 2
+                            else:
+                                rttvar = (1 - RTT_BETA) * rttvar + RTT_BETA * abs(srtt - sample)
+                                srtt = (1 - RTT_ALPHA) * srtt + RTT_ALPHA * sample
+                            rto_ns = min(max_rto_ns, max(min_rto_ns, int(srtt + 4 * rttvar)))
+
+                        if newly_acked:
+                            # Update base if possible
+                            while base_seq_num < total_packets and acked[base_seq_num]:
+                                base_seq_num += 1
+
+                            # Dynamically adjust window size based on progress
+                            if remaining_time_percent < 40 and len(in_flight) < current_window_size//2:
+                                # If we're making good progress despite time pressure, be more aggressive
+                                # Try to send multiple packets for each ACK received when window is not full
+                                pending = []
+                                for _ in range(min(3, current_window_size - len(in_flight))):
+                                    if next_seq_num < total_packets:
+                                        sent_time[next_seq_num] = now_ns
+                                        deadline[next_seq_num] = now_ns + rto_ns
+                                        heapq.heappush(timers, (deadline[next_seq_num], next_seq_num))
+                                        in_flight.add(next_seq_num)
+                                        pending.append(packet_view[next_seq_num * packet_size:(next_seq_num + 1) * packet_size])
+                                        next_seq_num += 1
+                                if pending:
+                                    send_batch(sock, pending, server_addr)
+
+                            # More frequent progress updates for high RTT
+                            if base_seq_num >= next_progress_report:
+                                progress = (base_seq_num / total_packets) * 100
+                                print(f"Progress: {progress:.1f}% (ACK: {cum_ack})")
+                                next_progress_report = base_seq_num + progress_step
+                    except struct.error:
+                        print("Received malformed ACK, ignoring")
+                ack_credit = max(1, ack_credit)
+
+            # Check for packets whose retransmission deadline has passed, even while ACKs keep arriving
+            now_ns = time.monotonic_ns()
+            pending = []  # Timed-out packets to resend in one batch
+            timed_out = find_timeouts(timers, deadline, in_flight, now_ns)
+            if timed_out:
+                # Back off the shared RTO on expiry (RFC 6298 5.5) so retransmissions and new
+                # packets both wait longer, until a valid RTT sample resets it
+                rto_ns = min(rto_ns * 2, max_rto_ns)
+            for seq_num in timed_out:
+                retries = retry_counts[seq_num]
+                if retries >= MAX_RETRIES:
+                    print(f"Packet {seq_num} failed after {MAX_RETRIES} retries")
+                    return False
+            
+                # Retransmit with the backed-off RTO (Karn/Partridge)
+                pending.append(packet_view[seq_num * packet_size:(seq_num + 1) * packet_size])
+                if len(pending) >= SEND_BATCH:
+                    send_batch(sock, pending, server_addr)
+                    pending = []
+                sent_time[seq_num] = now_ns
+                deadline[seq_num] = now_ns + rto_ns
+                heapq.heappush(timers, (deadline[seq_num], seq_num))
+                retry_counts[seq_num] = retries + 1
+                # Only print occasionally to avoid slowing down execution
+                if retries <= 1 or retries % 5 == 0:
+                    print(f"Timeout! Resending packet {seq_num} (retry {retries+1})")
+            if pending:
+                send_batch(sock, pending, server_addr)
+    finally:
+        # Stop the reader before the socket can be closed underneath it
+        stop_reader.set()
+        reader.join()
+        if base_seq_num < total_packets:  # Aborted, there is no termination exchange
+            sock.close()
+
     # Send termination packet
-    term_packet = struct.pack("!II", total_packets, total_packets)
+    term_packet = _HDR.pack(total_packets, total_packets)
     ack_received = False
     retries = 0
     
@@ -278,17 +435,8 @@ def send_file(file_path, server_ip, server_port):
             if extreme_rtt_mode:
                 repeat_count = 20
                 
-            # Determine delay between packets based on RTT mode
-            delay_time = 0.01  # Default
-            if high_rtt_mode:
-                delay_time = 0.02
-            if extreme_rtt_mode:
-                delay_time = 0.05
-                
-            # Send multiple termination packets to increase reliability
-            for _ in range(repeat_count):
-                sock.sendto(term_packet, (server_ip, server_port))
-                time.sleep(delay_time)  # Small delay between sends, longer for high RTT
+            # Send multiple termination packets back to back (one sendmmsg) to increase reliability
+            send_batch(sock, [term_packet] * repeat_count, server_addr)
             
             # Wait for ACK with timeout adjusted for RTT
             termination_timeout = 1.0  # Default
@@ -297,23 +445,24 @@ def send_file(file_path, server_ip, server_port):
             if extreme_rtt_mode:
                 termination_timeout = 5.0
                 
-            sock.settimeout(termination_timeout)
-            ack, _ = sock.recvfrom(BUFFER_SIZE)
-            ack_num = struct.unpack("!I", ack)[0]
-            
-            if ack_num == total_packets:
+            received = recv_datagram(sock, sel, BUFFER_SIZE, termination_timeout)
+            if received is None:
+                retries += 1
+                print(f"Termination timeout! Retry {retries}/{MAX_RETRIES}")
+                # Add a small delay for high RTT to let the network settle
+                if extreme_rtt_mode:
+                    time.sleep(0.2)  # Longer delay for Case 6
+                elif high_rtt_mode:
+                    time.sleep(0.1)  # Shorter delay for other high RTT cases
+                continue
+
+            # Late data ACKs carry the same cumulative ack, only the marker identifies the termination ACK
+            response = received[0]
+            if len(response) == ACK_HEADER_SIZE and _ACK_UNPACK_FROM(response) == (total_packets, TERM_ACK_MARKER):
                 ack_received = True
                 print("Termination acknowledged!")
             else:
                 retries += 1
-        except socket.timeout:
-            retries += 1
-            print(f"Termination timeout! Retry {retries}/{MAX_RETRIES}")
-            # Add a small delay for high RTT to let the network settle
-            if extreme_rtt_mode:
-                time.sleep(0.2)  # Longer delay for Case 6
-            elif high_rtt_mode:
-                time.sleep(0.1)  # Shorter delay for other high RTT cases
         except Exception as e:
             print(f"Error during termination: {e}")
             retries += 1
@@ -0,0 +1,218 @@
+import ctypes
+import ctypes.util
+import functools
+import os
+import selectors
+import socket
+import struct
+import sys
+import time
+
+# Constants
+SEND_BATCH = 64  # Max datagrams handed to the kernel per sendmmsg call
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024  # Default SO_RCVBUF/SO_SNDBUF request (override with URFT_RCVBUF/URFT_SNDBUF)
+MIN_SOCKET_BUFFER = 1024 * 1024  # Warn when the kernel grants less than this
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)  # Linux values, not exported by every Python build
+IP_PMTUDISC_DO = getattr(socket, "IP_PMTUDISC_DO", 2)
+
+# Load sendmmsg from libc where available (Linux only)
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _libc.sendmmsg  # Make sure the symbols exist (glibc >= 2.14)
+        _libc.recvmmsg
+    except (OSError, AttributeError):
+        _libc = None
+
+
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort),
+                ("sin_port", ctypes.c_ubyte * 2),  # Network byte order
+                ("sin_addr", ctypes.c_ubyte * 4),
+                ("sin_zero", ctypes.c_ubyte * 8)]
+
+
+if _libc is not None:
+    _libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    _libc.sendmmsg.restype = ctypes.c_int
+    _libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _libc.recvmmsg.restype = ctypes.c_int
+
+# Preallocated message arrays, reused for every send batch
+_send_msgs = (_MMsgHdr * SEND_BATCH)()
+_send_iov = (_IoVec * SEND_BATCH)()
+for _i in range(SEND_BATCH):
+    _send_msgs[_i].msg_hdr.msg_iov = ctypes.pointer(_send_iov[_i])
+    _send_msgs[_i].msg_hdr.msg_iovlen = 1
+
+
+def configure_socket(sock):
+    """Apply large socket buffers and path MTU discovery to a UDP socket.
+
+    Also switches the socket to non-blocking mode and returns a selector
+    registered for readability, used instead of socket timeouts.
+    """
+    for option, env_name, sysctl in ((socket.SO_RCVBUF, "URFT_RCVBUF", "net.core.rmem_max"),
+                                     (socket.SO_SNDBUF, "URFT_SNDBUF", "net.core.wmem_max")):
+        try:
+            requested = int(os.environ.get(env_name, SOCKET_BUFFER_SIZE))
+        except ValueError:
+            print(f"Warning: Invalid {env_name} value, using {SOCKET_BUFFER_SIZE} bytes")
+            requested = SOCKET_BUFFER_SIZE
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, requested)
+        except OSError:
+            print(f"Warning: Couldn't set socket buffer size ({env_name}={requested})")
+
+        # The kernel may silently cap the value, so read back what was actually granted
+        granted = sock.getsockopt(socket.SOL_SOCKET, option)
+        if granted < MIN_SOCKET_BUFFER:
+            print(f"Warning: {env_name} granted only {granted} bytes, consider raising {sysctl}")
+
+    # Set the don't-fragment bit so oversized datagrams fail instead of being fragmented
+    try:
+        if sys.platform.startswith("linux"):
+            sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        elif hasattr(socket, "IP_DONTFRAGMENT"):  # Windows
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_DONTFRAGMENT, 1)
+    except OSError:
+        pass
+
+    sock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+    return sel
+
+
+@functools.lru_cache(maxsize=16)
+def _sockaddr(addr):
+    # Build (and cache) the sockaddr_in for a destination address
+    ip, port = addr
+    raw = struct.pack("=H", socket.AF_INET) + struct.pack("!H", port)
+    raw += socket.inet_aton(socket.gethostbyname(ip)) + bytes(8)
+    return _SockAddrIn.from_buffer_copy(raw)
+
+
+@functools.lru_cache(maxsize=4)
+def _recv_arrays(count, buffer_size):
+    # Preallocate receive buffers, source addresses and message headers
+    msgs = (_MMsgHdr * count)()
+    iov = (_IoVec * count)()
+    bufs = [ctypes.create_string_buffer(buffer_size) for _ in range(count)]
+    addrs = (_SockAddrIn * count)()
+    for i in range(count):
+        iov[i].iov_base = ctypes.addressof(bufs[i])
+        iov[i].iov_len = buffer_size
+        hdr = msgs[i].msg_hdr
+        hdr.msg_iov = ctypes.pointer(iov[i])
+        hdr.msg_iovlen = 1
+        hdr.msg_name = ctypes.addressof(addrs[i])
+    return msgs, bufs, addrs
+
+
+def _buffer_address(buf, keep):
+    # Return the address of a bytes-like object without copying it
+    if isinstance(buf, bytes):
+        return ctypes.cast(ctypes.c_char_p(buf), ctypes.c_void_p).value
+    view = (ctypes.c_char * len(buf)).from_buffer(buf)
+    keep.append(view)  # Keep the exported buffer alive until the syscall returns
+    return ctypes.addressof(view)
+
+
+def _sendmmsg(fd, packets, sa):
+    # Send up to SEND_BATCH packets in one syscall, returns the number sent or -1
+    keep = []
+    for i, packet in enumerate(packets):
+        _send_iov[i].iov_base = _buffer_address(packet, keep)
+        _send_iov[i].iov_len = len(packet)
+        hdr = _send_msgs[i].msg_hdr
+        hdr.msg_name = ctypes.addressof(sa)
+        hdr.msg_namelen = ctypes.sizeof(sa)
+    return _libc.sendmmsg(fd, _send_msgs, len(packets), 0)
+
+
+def send_batch(sock, packets, addr):
+    """Send a list of datagrams to addr, batching syscalls with sendmmsg when possible."""
+    sent = 0
+    if _libc is not None:
+        sa = _sockaddr(addr)
+        fd = sock.fileno()
+        while sent < len(packets):
+            count = _sendmmsg(fd, packets[sent:sent + SEND_BATCH], sa)
+            if count <= 0:
+                break  # Fall back to plain sendto for whatever is left
+            sent += count
+
+    # Fallback path (Windows, old libc or sendmmsg failure)
+    try:
+        for packet in packets[sent:]:
+            sock.sendto(packet, addr)
+            sent += 1
+    except BlockingIOError:
+        pass  # Send buffer full, the rest is treated as lost and retransmitted later
+    return sent
+
+
+def recv_batch(sock, max_count, buffer_size):
+    """Drain up to max_count datagrams already queued on the socket, without blocking.
+
+    Returns a (possibly empty) list of (data, addr) tuples.
+    """
+    batch = []
+    if _libc is None:
+        # Fallback path: the socket is non-blocking, so recvfrom stops once the queue is empty
+        try:
+            while len(batch) < max_count:
+                batch.append(sock.recvfrom(buffer_size))
+        except BlockingIOError:
+            pass
+        return batch
+
+    msgs, bufs, addrs = _recv_arrays(max_count, buffer_size)
+    for i in range(max_count):
+        msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+    received = _libc.recvmmsg(sock.fileno(), msgs, max_count, MSG_DONTWAIT, None)
+    for i in range(max(received, 0)):  # -1 means nothing was queued
+        data = ctypes.string_at(bufs[i], msgs[i].msg_len)
+        ip = socket.inet_ntoa(bytes(addrs[i].sin_addr))
+        port = struct.unpack("!H", bytes(addrs[i].sin_port))[0]
+        batch.append((data, (ip, port)))
+    return batch
+
+
+def recv_datagram(sock, sel, buffer_size, timeout):
+    """Wait up to timeout seconds for one datagram on a non-blocking socket.
+
+    Returns (data, addr), or None if nothing arrived in time.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining < 0 or not sel.select(remaining):
+            return None
+        try:
+            return sock.recvfrom(buffer_size)
+        except BlockingIOError:
+            continue  # Spurious wakeup, keep waiting
@@ -6,76 +6,136 @@ import time
 import hashlib
 import shutil
 
+from urft_net import configure_socket, recv_batch, recv_datagram, send_batch
+
 # Constants
-BUFFER_SIZE = 4096
+MAX_DATAGRAM_SIZE = 8972  # Largest MTU probe / data packet the client may send (jumbo frames)
+BUFFER_SIZE = MAX_DATAGRAM_SIZE + 64
+DEFAULT_CHUNK_SIZE = 1024  # Chunk size assumed when the header doesn't carry one
+RECV_BATCH = 32  # Max datagrams drained from the socket per wakeup
+ACK_EVERY = 16  # Send a cumulative ACK at least this often within a batch
+WRITE_BATCH = 32  # In-order chunks collected before one vectored write
+SACK_RANGE = 256  # Sequence numbers covered by the selective ACK bitmap (32 bytes)
 MAX_PACKET_HISTORY = 1000  # Track this many most recent packets to handle duplicates
 SERVER_TIMEOUT = 120  # Increased timeout for Clumsy testing (especially Case 6)
 MAX_REASONABLE_PACKETS = 100000  # Safety limit to prevent invalid packet counts
 CREATE_BACKUP = False  # Set to True if you want to create backups before replacing files
 
+# Precompiled packet layouts (skip the format-string lookup on every call)
+_HDR = struct.Struct("!II")  # Data packet header: seq_num, total_packets
+_HDR_UNPACK_FROM = _HDR.unpack_from
+_ACK_HDR = struct.Struct("!II")  # ACK header: cumulative ack, SACK base
+TERM_ACK_MARKER = 0xFFFFFFFF  # SACK base of the termination ACK, never used by data ACKs
+_BIT_CHARS = bytes.maketrans(b"\x00\x01", b"01")  # received[] flags -> binary digits
+
+def build_ack(expected_seq, received, highest_seq, ack_table):
+    # ACK = cumulative ack + SACK base, followed by a bitmap of buffered
+    # out-of-order packets (omitted when there are none). The bitmap slides
+    # to cover the newest buffered packets; older ones were reported earlier.
+    # Plain cumulative ACKs come prebuilt from ack_table.
+    if highest_seq <= expected_seq:
+        return ack_table[expected_seq]
+    sack_base = max(expected_seq + 1, highest_seq - SACK_RANGE + 1)
+    # Reverse the flags so that sack_base ends up in the least significant bit
+    window = received[sack_base:highest_seq + 1][::-1].translate(_BIT_CHARS)
+    bitmap = int(window, 2)
+    return _ACK_HDR.pack(expected_seq, sack_base) + bitmap.to_bytes(SACK_RANGE // 8, "little")
+
+def flush_writes(f, pending_writes, file_hash):
+    # Write all queued chunks in one writev syscall where available (not on Windows),
+    # hashing them on the way so the file never has to be read back
+    if pending_writes:
+        if file_hash is not None:
+            for chunk in pending_writes:
+                file_hash.update(chunk)
+        if hasattr(os, "writev"):
+            total = sum(len(chunk) for chunk in pending_writes)
+            written = os.writev(f.fileno(), pending_writes)
+            if written < total:  # Short write, finish the remainder
+                remainder = memoryview(b"".join(pending_writes))[written:]
+                while remainder:
+                    remainder = remainder[os.write(f.fileno(), remainder):]
+        else:
+            f.writelines(pending_writes)
+        pending_writes.clear()
+
 def receive_file(server_ip, server_port):
     start_time = time.time()
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.bind((server_ip, server_port))
-    sock.settimeout(SERVER_TIMEOUT)  # Add timeout to prevent blocking indefinitely
 
-    # Set socket buffer size to handle larger packets
-    try:
-        # Increase socket buffer sizes
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)  # 256 KB receive buffer
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 262144)  # 256 KB send buffer
-    except:
-        print("Warning: Couldn't set socket buffer size")
+    # Set socket buffer sizes (tunable via URFT_RCVBUF/URFT_SNDBUF) and path MTU discovery,
+    # waits go through the selector (with SERVER_TIMEOUT) instead of socket timeouts
+    sel = configure_socket(sock)
     
     print(f"Server listening on {server_ip}:{server_port}")
     print("NOTE: Configure and run Clumsy if testing network conditions")
     
     # Receive header
     header_received = False
-    file_md5 = None  # Initialize MD5 field
+    file_digest = None  # Initialize digest field
+    chunk_size = DEFAULT_CHUNK_SIZE
+    hash_algo = "md5"  # Older clients send name:size:md5 without an algorithm id
     high_rtt_mode = False  # Track if we're in high RTT mode
+    header_data = None  # Raw header, to recognise retransmissions of it
+    header_ack_time = None  # When the last HEADER_ACK was sent
     
     while not header_received:
         try:
-            data, client_addr = sock.recvfrom(BUFFER_SIZE)
+            received = recv_datagram(sock, sel, BUFFER_SIZE, SERVER_TIMEOUT)
+            if received is None:
+                print("Timed out waiting for header")
+                return False
+            data, client_addr = received
             
-            # Check if this is an RTT probe
-            if data == b"RTT_PROBE":
-                sock.sendto(b"RTT_ACK", client_addr)
-                # Record that we're likely in high RTT mode if we get multiple probes
-                high_rtt_mode = True
+            # Echo path MTU probes with the size that arrived
+            if data.startswith(b"MTU_PROBE"):
+                sock.sendto(b"MTU_ACK" + struct.pack("!I", len(data)), client_addr)
                 continue
-                
+
             try:
                 header_parts = data.decode().split(":")
                 file_name = header_parts[0]
                 file_size = int(header_parts[1])
-                if len(header_parts) > 2:
-                    file_md5 = header_parts[2]
+                if len(header_parts) > 3:
+                    hash_algo = header_parts[2]
+                    file_digest = header_parts[3]
+                elif len(header_parts) > 2:
+                    file_digest = header_parts[2]
+                if len(header_parts) > 4:
+                    chunk_size = int(header_parts[4])
+                    if chunk_size <= 0 or chunk_size + 8 > MAX_DATAGRAM_SIZE:
+                        raise ValueError(f"unsupported chunk size {chunk_size}")
+                if file_digest and hash_algo not in hashlib.algorithms_available:
+                    print(f"WARNING: Unsupported hash algorithm {hash_algo}, falling back to size verification")
+                    file_digest = None
                 
                 header_received = True
-                print(f"Receiving file: {file_name} ({file_size} bytes)")
-                if file_md5:
-                    print(f"Expected MD5: {file_md5}")
+                print(f"Receiving file: {file_name} ({file_size} bytes, {chunk_size}-byte chunks)")
+                if file_digest:
+                    print(f"Expected {hash_algo}: {file_digest}")
                 sock.sendto(b"HEADER_ACK", client_addr)
+                header_data = data
+                header_ack_time = time.time()
             except Exception as e:
                 print(f"Invalid header received: {e}")
-        except socket.timeout:
-            print("Timed out waiting for header")
-            return False
         except Exception as e:
             print(f"Error receiving header: {e}")
     
     # Calculate expected number of packets based on file size and chunk size
-    expected_packets = (file_size + 1023) // 1024  # Ceiling division by chunk size
+    expected_packets = (file_size + chunk_size - 1) // chunk_size  # Ceiling division by chunk size
     print(f"Expecting approximately {expected_packets} packets based on file size")
     
     # Create output file
     output_file = "received_" + file_name
     
     # Set up packet tracking
-    received_seq_nums = set()  # Track all received sequence numbers to detect duplicates
-    received_packets = {}  # Buffer for out-of-order packets: seq_num -> data
+    received = bytearray()  # One flag per sequence number, allocated once total_packets is known
+    out_of_order_buf = []  # Out-of-order packet data, indexed by sequence number
+    highest_seq = -1  # Highest sequence number received so far
+    pending_writes = []  # In-order chunks not yet written to the file
+    ack_table = []  # Prebuilt cumulative ACK for every sequence number, filled once total_packets is known
+    file_hash = hashlib.new(hash_algo) if file_digest else None  # Updated as chunks are written, in file order
     expected_seq = 0  # Next expected sequence number
     total_packets = 0  # Initialize total_packets before use
     transfer_complete = False
@@ -87,109 +147,8 @@ def receive_file(server_ip, server_port):
     with open(output_file, "wb") as f:
         # Process data packets
         while not transfer_complete:
-            try:
-                data, client_addr = sock.recvfrom(BUFFER_SIZE)
-                last_activity_time = time.time()  # Update activity timestamp
-                
-                # Handle RTT probe packets that might come at any time
-                if data == b"RTT_PROBE":
-                    sock.sendto(b"RTT_ACK", client_addr)
-                    high_rtt_mode = True  # Enable high RTT mode
-                    continue
-                    
-                # Extract sequence number and total packets
-                header_size = struct.calcsize("!II")
-                if len(data) < header_size:
-                    print("Received malformed packet (too small)")
-                    continue
-                
-                try:
-                    seq_num, packet_total = struct.unpack("!II", data[:header_size])
-                    data_chunk = data[header_size:]
-                    
-                    # Sanity check for packet_total (prevent absurdly large values)
-                    if packet_total > MAX_REASONABLE_PACKETS or packet_total == 0:
-                        # If packet total is unreasonable, use our expected value instead
-                        if expected_packets > 0:
-                            print(f"WARNING: Received invalid packet total: {packet_total}, using {expected_packets} instead")
-                            packet_total = expected_packets
-                        else:
-                            print(f"WARNING: Received invalid packet total: {packet_total}, ignoring packet")
-                            continue
-                    
-                    # Set total packets if not already set or validate against expected
-                    if total_packets == 0:
-                        total_packets = packet_total
-                        print(f"Expecting {total_packets} packets based on packet header")
-                        
-                        # Sanity check against file size calculation
-                        if abs(total_packets - expected_packets) > expected_packets * 0.5:
-                            print(f"WARNING: Packet count ({total_packets}) differs significantly from expected ({expected_packets})")
-                            # Trust the expected calculation if it's reasonable
-                            if expected_packets > 0 and expected_packets < MAX_REASONABLE_PACKETS:
-                                print(f"Using {expected_packets} as packet count based on file size")
-                                total_packets = expected_packets
-                    
-                    # Termination packet
-                    if seq_num == total_packets and packet_total == total_packets:
-                        print("Received termination packet, sending acknowledgment")
-                        # Send termination ACK multiple times for reliability
-                        # More repeated ACKs for high RTT cases
-                        repeat_count = 15 if high_rtt_mode else 5
-                        delay_time = 0.05 if high_rtt_mode else 0.01
-                        
-                        for _ in range(repeat_count):
-                            sock.sendto(struct.pack("!I", total_packets), client_addr)
-                            time.sleep(delay_time)  # Longer delay for high RTT
-                        
-                        transfer_complete = True
-                        break
-                    
-                    # Sanity check for sequence number
-                    if seq_num >= total_packets:
-                        print(f"WARNING: Received invalid sequence number: {seq_num} >= {total_packets}")
-                        continue
-                    
-                    # Check if packet is a duplicate
-                    if seq_num in received_seq_nums:
-                        # Send ACK for duplicates without extra overhead
-                        sock.sendto(struct.pack("!I", seq_num), client_addr)
-                        continue
-                    
-                    # If we receive the packet we expect
-                    if seq_num == expected_seq:
-                        f.write(data_chunk)
-                        received_seq_nums.add(seq_num)
-                        expected_seq += 1
-                        
-                        # Process any buffered packets that are now in order
-                        while expected_seq in received_packets:
-                            f.write(received_packets[expected_seq])
-                            received_seq_nums.add(expected_seq)
-                            del received_packets[expected_seq]
-                            expected_seq += 1
-                        
-                        # Report progress at reasonable intervals
-                        if total_packets > 0:
-                            current_progress = (expected_seq / total_packets) * 100
-                            # Only print if progress has increased significantly
-                            if current_progress - last_progress_report >= 5 or expected_seq >= total_packets:
-                                print(f"Progress: {current_progress:.1f}% (Received: {seq_num})")
-                                last_progress_report = current_progress
-                    
-                    # Out of order packet, buffer it
-                    elif seq_num > expected_seq:
-                        received_packets[seq_num] = data_chunk
-                        received_seq_nums.add(seq_num)
-                    
-                    # Send ACK (single ACK for efficiency)
-                    sock.sendto(struct.pack("!I", seq_num), client_addr)
-                    
-                except struct.error as e:
-                    print(f"Error unpacking packet header: {e}")
-                    continue
-                
-            except socket.timeout:
+            # Wait for data without relying on socket.timeout exceptions
+            if not sel.select(SERVER_TIMEOUT):
                 current_time = time.time()
                 # Adaptive timeout strategy for high RTT scenarios
                 inactive_time = current_time - last_activity_time
@@ -211,6 +170,135 @@ def receive_file(server_ip, server_port):
                 
                 continue  # Continue waiting for packets
 
+            try:
+                batch = recv_batch(sock, RECV_BATCH, BUFFER_SIZE)
+                if not batch:
+                    continue  # Spurious wakeup
+                last_activity_time = time.time()  # Update activity timestamp
+                unacked = 0  # Data packets since the last ACK, one cumulative ACK covers them all
+
+                for data, client_addr in batch:
+                    # Late duplicates of the path MTU probes
+                    if data.startswith(b"MTU_PROBE"):
+                        continue
+
+                    # The client resends the header if our HEADER_ACK was lost
+                    if data == header_data:
+                        send_batch(sock, [b"HEADER_ACK"], client_addr)
+                        header_ack_time = time.time()
+                        continue
+
+                    # The client starts sending right after the HEADER_ACK arrives,
+                    # so the gap until its first data packet approximates the RTT
+                    if header_ack_time is not None:
+                        high_rtt_mode = last_activity_time - header_ack_time > 0.1  # Over 100ms RTT
+                        header_ack_time = None
+                    
+                    # Extract sequence number and total packets
+                    header_size = _HDR.size
+                    if len(data) < header_size:
+                        print("Received malformed packet (too small)")
+                        continue
+                
+                    try:
+                        seq_num, packet_total = _HDR_UNPACK_FROM(data)
+                        data_chunk = memoryview(data)[header_size:]
+                    
+                        # Sanity check for packet_total (prevent absurdly large values)
+                        if packet_total > MAX_REASONABLE_PACKETS or packet_total == 0:
+                            # If packet total is unreasonable, use our expected value instead
+                            if expected_packets > 0:
+                                print(f"WARNING: Received invalid packet total: {packet_total}, using {expected_packets} instead")
+                                packet_total = expected_packets
+                            else:
+                                print(f"WARNING: Received invalid packet total: {packet_total}, ignoring packet")
+                                continue
+                    
+                        # Set total packets if not already set or validate against expected
+                        if total_packets == 0:
+                            total_packets = packet_total
+                            print(f"Expecting {total_packets} packets based on packet header")
+                        
+                            # Sanity check against file size calculation
+                            if abs(total_packets - expected_packets) > expected_packets * 0.5:
+                                print(f"WARNING: Packet count ({total_packets}) differs significantly from expected ({expected_packets})")
+                                # Trust the expected calculation if it's reasonable
+                                if expected_packets > 0 and expected_packets < MAX_REASONABLE_PACKETS:
+                                    print(f"Using {expected_packets} as packet count based on file size")
+                                    total_packets = expected_packets
+                            received = bytearray(total_packets)
+                            out_of_order_buf = [None] * total_packets
+                            ack_table = [_ACK_HDR.pack(i, i + 1) for i in range(total_packets + 1)]
+                    
+                        # Termination packet
+                        if seq_num == total_packets and packet_total == total_packets:
+                            print("Received termination packet, sending acknowledgment")
+                            # Send termination ACK multiple times for reliability, back to back in one batch
+                            # More repeated ACKs for high RTT cases
+                            repeat_count = 15 if high_rtt_mode else 5
+                            term_ack = _ACK_HDR.pack(total_packets, TERM_ACK_MARKER)
+                            send_batch(sock, [term_ack] * repeat_count, client_addr)
+                        
+                            transfer_complete = True
+                            break
+                    
+                        # Sanity check for sequence number
+                        if seq_num >= total_packets:
+                            print(f"WARNING: Received invalid sequence number: {seq_num} >= {total_packets}")
+                            continue
+                    
+                        # Check if packet is a duplicate
+                        if received[seq_num]:
+                            # Re-ACK duplicates, the client probably missed our last ACK
+                            unacked += 1
+                            continue
+                    
+                        # If we receive the packet we expect
+                        if seq_num == expected_seq:
+                            pending_writes.append(data_chunk)
+                            received[seq_num] = 1
+                            expected_seq += 1
+                        
+                            # Process any buffered packets that are now in order
+                            while expected_seq < total_packets and received[expected_seq]:
+                                pending_writes.append(out_of_order_buf[expected_seq])
+                                out_of_order_buf[expected_seq] = None
+                                expected_seq += 1
+                            
+                            if len(pending_writes) >= WRITE_BATCH:
+                                flush_writes(f, pending_writes, file_hash)
+                        
+                            # Report progress at reasonable intervals
+                            if total_packets > 0:
+                                current_progress = (expected_seq / total_packets) * 100
+                                # Only print if progress has increased significantly
+                                if current_progress - last_progress_report >= 5 or expected_seq >= total_packets:
+                                    print(f"Progress: {current_progress:.1f}% (Received: {seq_num})")
+                                    last_progress_report = current_progress
+                    
+                        # Out of order packet, buffer it
+                        elif seq_num > expected_seq:
+                            received[seq_num] = 1
+                            out_of_order_buf[seq_num] = data_chunk
+                        
+                        if seq_num > highest_seq:
+                            highest_seq = seq_num
+                    
+                        unacked += 1
+                        if unacked >= ACK_EVERY:
+                            send_batch(sock, [build_ack(expected_seq, received, highest_seq, ack_table)], client_addr)
+                            unacked = 0
+                    
+                    except struct.error as e:
+                        print(f"Error unpacking packet header: {e}")
+                        continue
+
+                # ACKs go through send_batch, which treats a full send buffer as loss instead of
+                # raising and abandoning the rest of an already dequeued batch
+                if unacked:
+                    send_batch(sock, [build_ack(expected_seq, received, highest_seq, ack_table)], client_addr)
+                flush_writes(f, pending_writes, file_hash)
+
             except socket.error as e:
                 # Handle Windows-specific socket errors
                 if hasattr(e, 'winerror') and e.winerror == 10054:  # Connection forcibly closed
@@ -229,11 +317,13 @@ def receive_file(server_ip, server_port):
             except Exception as e:
                 print(f"Error during file transfer: {e}")
                 continue  # Try to continue despite errors
+        
+        flush_writes(f, pending_writes, file_hash)
     
     end_time = time.time()
     duration = end_time - start_time
     
-    # Verify file size and MD5
+    # Verify file size and hash
     received_size = os.path.getsize(output_file)
     
     print(f"File transfer complete: {output_file}")
@@ -242,22 +332,18 @@ def receive_file(server_ip, server_port):
     
     verification_success = False
     
-    # Verify with MD5 if available
-    if file_md5:
-        print("Verifying file integrity with MD5...")
-        md5_hash = hashlib.md5()
-        with open(output_file, "rb") as f_hash:
-            for chunk in iter(lambda: f_hash.read(4096), b""):
-                md5_hash.update(chunk)
-        received_md5 = md5_hash.hexdigest()
+    # Verify with the client's hash if available
+    if file_digest:
+        print(f"Verifying file integrity with {hash_algo}...")
+        received_digest = file_hash.hexdigest()
         
-        print(f"Computed MD5: {received_md5}")
+        print(f"Computed {hash_algo}: {received_digest}")
         
-        if received_md5 == file_md5:
-            print("MD5 verification: SUCCESS")
+        if received_digest == file_digest:
+            print(f"{hash_algo} verification: SUCCESS")
             verification_success = True
             
-            # Replace test_file.bin with the received file if MD5 verified
+            # Replace test_file.bin with the received file if the hash verified
             try:
                 # Create backup if enabled
                 if CREATE_BACKUP and os.path.exists(file_name):
@@ -276,12 +362,12 @@ def receive_file(server_ip, server_port):
             except Exception as e:
                 print(f"Error during file replacement: {e}")
         else:
-            print(f"MD5 verification: FAILED")
-            print(f"Expected: {file_md5}")
-            print(f"Received: {received_md5}")
+            print(f"{hash_algo} verification: FAILED")
+            print(f"Expected: {file_digest}")
+            print(f"Received: {received_digest}")
             verification_success = False
     else:
-        # Fallback to size verification if no MD5
+        # Fallback to size verification if no hash
         if received_size == file_size:
             print("Size verification: SUCCESS")
             verification_success = True